@@ -9,64 +9,77 @@ Date: 2025-09-03
 Description:
 Rescales BMP images and coordinates in .wps, .sbs, .fms files
 of a Rockbox theme. Copies other files without modifying them.
+
+Requirements: Pillow (or the drop-in pillow-simd for faster resampling), tqdm.
 """
 
 import argparse
+import functools
 from pathlib import Path
 from PIL import Image
 from tqdm import tqdm
 import shutil
 import re
-import subprocess, os
-
-def get_bit_depth(file_path):
-    result = subprocess.run(
-        ['identify', '-format', '%z', file_path],
-        capture_output=True, text=True
-    )
-    if result.returncode == 0:
-        bit_depth = int(result.stdout.strip())
-        return bit_depth
-    else:
-        return None
-
-def get_width(file_path):
-    result = subprocess.run(
-        ['identify', '-format', '%w', file_path],
-        capture_output=True, text=True
-    )
-    if result.returncode == 0:
-        width = int(result.stdout.strip())
-        return width
-    else:
-        return None
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
 
+@functools.lru_cache(maxsize=None)
+def get_bmp_info(file_path):
+    """Return (width, bit_depth) of a BMP, or (None, None) if it cannot be read."""
+    try:
+        with open(file_path, "rb") as f:
+            header = f.read(30)
+        if header[:2] != b"BM":
+            raise ValueError("not a BMP file")
+        # biWidth and biBitCount follow the 14-byte file header; OS/2 core
+        # headers (12 bytes long) use 16-bit width/height fields
+        if struct.unpack_from("<I", header, 14)[0] == 12:
+            width = struct.unpack_from("<H", header, 18)[0]
+            bit_depth = struct.unpack_from("<H", header, 24)[0]
+        else:
+            width = struct.unpack_from("<i", header, 18)[0]
+            bit_depth = struct.unpack_from("<H", header, 28)[0]
+        return width, bit_depth
+    except Exception as e:
+        print(f"Error opening image {file_path}: {e}")
+        return None, None
+
+def rescale_image(input_path, factor, filter_bg, filter_icon):
+    """
+    Return the rescaled image and the source bit depth. If detected as an icon
+    (≤32px), NEAREST is used; otherwise, the configured filter is applied.
+    """
+    width, bit_depth = get_bmp_info(input_path)
+    resample = filter_icon if width <= 32 else filter_bg
+    with Image.open(input_path) as img:
+        new_size = (max(1, round(img.width * factor[0])), max(1, round(img.height * factor[1])))
+        if resample != Image.Resampling.NEAREST and img.mode in ("1", "P"):
+            # Pillow only filters palette/bilevel images with NEAREST
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        return img.resize(new_size, resample=resample, reducing_gap=2.0), bit_depth
+
+def save_bmp_1bpp(img, output_path):
+    """Write the image as a two-colour BMP without dithering."""
+    img.convert("1", dither=Image.Dither.NONE).save(output_path, format="BMP")
 
 def resize_bmp(input_path, output_path, factor, filter_bg, filter_icon):
     """
-    Rescale a BMP image. If detected as an icon (≤32px), NEAREST is used;
-    otherwise, the configured filter is applied.
+    Rescale a BMP image, keeping 1-bit images at 1 bit.
     """
-    factor = (1.5,1.5)
-    width = get_width(input_path)
-    bit_depth = get_bit_depth(input_path)
-    magick_filter = "Point"
-    os.system(f"mkdir -p \"{'/'.join(str(output_path).split('/')[:-1])}\"")
-    if bit_depth != 1:
-        if width <= 32:
-            os.system(f"magick '{input_path}' -filter Point -resize {int(factor[0]*100)}% '{output_path}'")
-        else:
-            os.system(f"magick '{input_path}' -filter {filter_bg} -resize {int(factor[0]*100)}% '{output_path}'")
+    img, bit_depth = rescale_image(input_path, factor, filter_bg, filter_icon)
+    # Never write through a hardlink to the source left by an earlier run
+    output_path.unlink(missing_ok=True)
+    if bit_depth == 1:
+        save_bmp_1bpp(img, output_path)
     else:
-        if width <= 32:
-            os.system(f"magick '{input_path}' -filter Point -resize {int(factor[0]*100)}% '{output_path}'")
-        else:
-            os.system(f"magick '{input_path}' -filter {filter_bg} -resize {int(factor[0]*100)}% '{output_path}'")
+        img.save(output_path, format="BMP")
 
-        os.system(f"magick '{output_path}' -monochrome -colors 2 -depth 1 '/tmp/{str(output_path).split('/')[-1]}'")
-        os.system(f"mv '/tmp/{str(output_path).split('/')[-1]}' '{output_path}'")
 def scale_value(val, factor):
     val = val.strip()
+    if val.isdecimal():
+        return str(int(int(val) * factor))  # common case: plain positive integer
     if val == '-' or val.endswith('%'):
         return val  # do not rescale special values
     try:
@@ -74,6 +87,7 @@ def scale_value(val, factor):
     except ValueError:
         return val
 
+@functools.lru_cache(maxsize=None)
 def get_image_height(image_path):
     """Retrieve the height of the image at the given path."""
     try:
@@ -83,65 +97,120 @@ def get_image_height(image_path):
         print(f"Error opening image {image_path}: {e}")
         return None  # Return None if there's an error
 
-def rescale_wps_file(file_path, out_path, factor_x, factor_y, FILTER_BG, FILTER_ICON):
+PATTERNS = {
+    "%V":  ["x","y","width","height","fontid"],
+    "%Vl": ["id","x","y","width","height","fontid"],
+    "%Vi": ["label","x","y","width","height","fontid"],
+    "%dr": ["x","y","width","height","colour1","colour2"],
+    "%pb": ["x","y","width","height","filename"],
+    "%pv": ["x","y","width","height","filename"],
+    "%x":  ["label","filename","x","y"],
+    "%xl": ["label","filename","x","y","nimages"],
+    "%Cl": ["xpos","ypos","maxwidth","maxheight","halign","valign"],
+    "%T":  ["label","x","y","width","height","action","options"],
+    "%Lb": ["viewport","width","height","tile"],
+    "%XX": ["x","y","width","height","filename","options"]
+}
+
+# Per-parameter axis for each tag: 0 = scaled by factor_x, 1 = by factor_y,
+# -1 = not a coordinate
+X_PARAMS = {"x", "width", "xpos", "maxwidth"}
+Y_PARAMS = {"y", "height", "ypos", "maxheight"}
+PARAM_AXES = {
+    key: [0 if name in X_PARAMS else 1 if name in Y_PARAMS else -1 for name in params]
+    for key, params in PATTERNS.items()
+}
+
+# A single alternation over all tags so each file is scanned once; group 1
+# is the tag (a key of PATTERNS), group 2 its parameter list
+TAG_REGEX = re.compile(
+    "(" + "|".join(re.escape(key) for key in sorted(PATTERNS, key=len, reverse=True)) + r")\(([^)\n]*)\)"
+)
+
+# Splits a parameter list and strips each parameter in one pass
+COMMA_SPLIT = re.compile(r"\s*,\s*")
+
+def plan_resize(bmp_plan, image_path, out_path, factor):
+    """
+    Record that image_path should be rescaled by factor into out_path. If the
+    image is already planned with another factor, the largest one is kept.
+    """
+    if image_path in bmp_plan and bmp_plan[image_path][1] != factor:
+        print(f"Conflicting nimages for {image_path}, using the largest factor")
+        factor = max(factor, bmp_plan[image_path][1])
+    bmp_plan[image_path] = (out_path, factor)
+
+def rescale_wps_file(file_path, out_path, factor_x, factor_y):
     """
     Rescale coordinates inside .wps, .sbs, or .fms files.
+    Returns the rescaled text and the resize plan for the strip images
+    referenced through nimages, as {source: (destination, factor)}.
     """
     try:
         text = file_path.read_text(encoding="utf-8")
     except UnicodeDecodeError:
         text = file_path.read_text(encoding="latin-1")
 
-    processed_bmps = []
-
-    patterns = {
-        "%V":  ["x","y","width","height","fontid"],
-        "%Vl": ["id","x","y","width","height","fontid"],
-        "%Vi": ["label","x","y","width","height","fontid"],
-        "%dr": ["x","y","width","height","colour1","colour2"],
-        "%pb": ["x","y","width","height","filename"],
-        "%pv": ["x","y","width","height","filename"],
-        "%x":  ["label","filename","x","y"],
-        "%xl": ["label","filename","x","y","nimages"],
-        "%Cl": ["xpos","ypos","maxwidth","maxheight","halign","valign"],
-        "%T":  ["label","x","y","width","height","action","options"],
-        "%Lb": ["viewport","width","height","tile"],
-        "%XX": ["x","y","width","height","filename","options"]
-    }
-
-    for key, params in patterns.items():
-        regex = re.compile(rf"{key}\((.*?)\)")
-        def repl(match):
-            parts = [p.strip() for p in match.group(1).split(",")]
-            for i, name in enumerate(params):
-                if i < len(parts):
-                    if name in ["x","y","width","height","xpos","ypos","maxwidth","maxheight"] and not ((key == "%xl") and (len(parts) == 5)):
-                        factor = factor_x if "x" in name else factor_y
-                        parts[i] = scale_value(parts[i], factor)
-                    elif name == "nimages":
-                        # Handle the nimages scaling
-                        image_filename = parts[1]  # Assuming the filename is the second parameter
-                        image_path = file_path.parent / file_path.stem / image_filename  # Construct the full path
-                        original_height = get_image_height(image_path)  # Get the original height
-                        scaled_height = int(original_height * factor_y)
-                        
-                        # Find the next best integer multiple of nimages
-                        nimages = int(parts[i]) if parts[i].isdigit() else 1
-                        if scaled_height % nimages != 0:
-                            factor_new = ((scaled_height // nimages) * nimages ) / original_height
-                            height_new = ((scaled_height // nimages) * nimages ) 
-                        else:
-                            factor_new = factor_x
-                        resize_bmp(image_path, Path(out_path.parent) / Path(out_path.stem) / image_filename, (factor_new, factor_new), FILTER_BG, FILTER_ICON)
-                        processed_bmps.append(image_path)
-
-            return f"{key}({','.join(parts)})"
-        text = regex.sub(repl, text)
-
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+    bmp_plan = {}
+
+    factors = (factor_x, factor_y)
+
+    def repl(match):
+        key = match.group(1)
+        params = PATTERNS[key]
+        axes = PARAM_AXES[key]
+        parts = COMMA_SPLIT.split(match.group(2).strip())
+        for i, name in enumerate(params):
+            if i < len(parts):
+                if axes[i] >= 0 and not ((key == "%xl") and (len(parts) == 5)):
+                    parts[i] = scale_value(parts[i], factors[axes[i]])
+                elif name == "nimages":
+                    # Handle the nimages scaling
+                    image_filename = parts[1]  # Assuming the filename is the second parameter
+                    image_path = file_path.parent / file_path.stem / image_filename  # Construct the full path
+                    original_height = get_image_height(image_path)  # Get the original height
+                    scaled_height = int(original_height * factor_y)
+                    
+                    # Find the next best integer multiple of nimages
+                    nimages = int(parts[i]) if parts[i].isdigit() else 1
+                    # The exact ratio makes rescale_image's round() land on height_new
+                    height_new = (scaled_height // nimages) * nimages
+                    factor_new = height_new / original_height
+                    plan_resize(bmp_plan, image_path, out_path.parent / out_path.stem / image_filename, (factor_new, factor_new))
+
+        return f"{key}({','.join(parts)})"
+    text = TAG_REGEX.sub(repl, text)
+
+    return text, bmp_plan
+
+def write_wps_file(out_path, text):
     out_path.write_text(text, encoding="utf-8")
 
-    return processed_bmps
+def iter_files(root):
+    """Yield a DirEntry for every regular file below root."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+def copy_file(file_path, out_path, hardlink=True):
+    """
+    Place an untouched file in the output theme, as a hardlink when possible
+    (same filesystem) and as a full copy otherwise.
+    """
+    # A previous run may have left a hardlink to the source here
+    out_path.unlink(missing_ok=True)
+    if hardlink:
+        try:
+            os.link(file_path, out_path)
+            return
+        except OSError:
+            pass
+    shutil.copy2(file_path, out_path)
 
 def main():
     parser = argparse.ArgumentParser(description="Rescale BMP images and WPS coordinates of a Rockbox theme.")
@@ -150,6 +219,8 @@ def main():
     parser.add_argument("output_res", choices=["240p", "360p"], help="Output resolution")
     parser.add_argument("--filter", choices=["NEAREST", "LANCZOS"], default="LANCZOS",
                         help="Filter for large images (default: LANCZOS)")
+    parser.add_argument("--no-hardlink", action="store_true",
+                        help="Copy untouched files instead of hardlinking them into the output")
     args = parser.parse_args()
 
     input_dir = Path(args.input_dir)
@@ -165,38 +236,68 @@ def main():
     factor_x = out_w / in_w
     factor_y = out_h / in_h
 
-    FILTER_BG = "Point" if args.filter.upper() == "NEAREST" else "Lanczos"
-    FILTER_ICON = "Point"
+    FILTER_BG = Image.Resampling.NEAREST if args.filter.upper() == "NEAREST" else Image.Resampling.LANCZOS
+    FILTER_ICON = Image.Resampling.NEAREST
 
-    files = list(input_dir.rglob("*"))
-    with tqdm(total=len(files), desc="Processing files") as pbar:
-        already_processed = []
-        # First pass: Process .wps, .sbs, .fms files
-        for file in files:
-            if not file.is_file():
-                pbar.update(1)
-                continue
+    files = []
+    wps_files, bmp_files, other_files = [], [], []
+    for entry in iter_files(input_dir):
+        file = Path(entry.path)
+        files.append(file)
+        ext = os.path.splitext(entry.name)[1].lower()
+        if ext == ".bmp":
+            bmp_files.append(file)
+        elif ext in [".wps", ".sbs", ".fms"]:
+            wps_files.append(file)
+        else:
+            other_files.append(file)
+
+    def out_file(file):
+        return output_dir / file.relative_to(input_dir)
 
-            rel_path = file.relative_to(input_dir)
-            out_file = output_dir / rel_path
+    # Mirror the directory tree once so no output step needs its own mkdir
+    for d in {out_file(f).parent for f in files}:
+        d.mkdir(parents=True, exist_ok=True)
 
-            rel_path = file.relative_to(input_dir)
-            out_file = output_dir / rel_path
+    with tqdm(total=len(files), desc="Processing files") as pbar, \
+            ProcessPoolExecutor(max_workers=os.cpu_count()) as pool, \
+            ThreadPoolExecutor() as io_pool:
+        # Writes and untouched files are I/O bound, run them alongside the image work
+        io_jobs = []
 
-            if file.suffix.lower() == ".bmp":
-                if file not in already_processed:
-                    resize_bmp(file, out_file, (factor_x, factor_y), FILTER_BG, FILTER_ICON)
+        def submit_io(fn, *fn_args):
+            future = io_pool.submit(fn, *fn_args)
+            future.add_done_callback(lambda _: pbar.update(1))
+            io_jobs.append(future)
 
-            elif file.suffix.lower() in [".wps", ".sbs", ".fms"]:
-                processed_bmps = rescale_wps_file(file, out_file, factor_x, factor_y, FILTER_BG, FILTER_ICON)
-                for b in processed_bmps:
-                    already_processed.append(b)
+        for f in other_files:
+            submit_io(copy_file, f, out_file(f), not args.no_hardlink)
 
-            else:
-                out_file.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(file, out_file)
+        # First pass: rescale .wps, .sbs, .fms files and plan their nimages strips
+        bmp_plan = {}
+        futures = {pool.submit(rescale_wps_file, f, out_file(f), factor_x, factor_y): f for f in wps_files}
+        for future in as_completed(futures):
+            text, plan = future.result()
+            submit_io(write_wps_file, out_file(futures[future]), text)
+            for image_path, (image_out, factor) in plan.items():
+                plan_resize(bmp_plan, image_path, image_out, factor)
 
+        # Second pass: every BMP is resized exactly once, with its nimages factor if it has one
+        for f in bmp_files:
+            bmp_plan.setdefault(f, (out_file(f), (factor_x, factor_y)))
+        pbar.total = len(wps_files) + len(bmp_plan) + len(other_files)
+        pbar.refresh()
+        # Nothing to resample at a 1.0 factor, place the original instead of re-encoding it
+        for f in [f for f, (_, factor) in bmp_plan.items() if factor == (1.0, 1.0)]:
+            submit_io(copy_file, f, bmp_plan.pop(f)[0], not args.no_hardlink)
+        sources = list(bmp_plan)
+        for _ in pool.map(resize_bmp, sources, [bmp_plan[f][0] for f in sources], [bmp_plan[f][1] for f in sources],
+                          repeat(FILTER_BG), repeat(FILTER_ICON), chunksize=8):
             pbar.update(1)
 
+        # Third pass: wait for the rescaled theme files and copied leftovers
+        for future in io_jobs:
+            future.result()
+
 if __name__ == "__main__":
     main()